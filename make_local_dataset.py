@@ -1,60 +1,197 @@
 import os
 import argparse
 import shutil
+import subprocess
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as pads
+import soundfile as sf
 from datasets import Dataset, DatasetDict, Audio
+from datasets.table import embed_table_storage
+
+
+def _parse_metadata_lines(csv_path: str):
+    """
+    Split metadata lines on the FIRST '|' using pyarrow's (multithreaded) CSV
+    reader plus vectorized string kernels. Each whole line is read as a single
+    column, so transcripts containing '|' are kept intact.
+    Returns two parallel lists: (rel_paths, texts), both stripped.
+    """
+    bad_rows = []
+
+    def _collect_bad_row(row):
+        bad_rows.append(row.text)
+        return "skip"
+
+    try:
+        tbl = pacsv.read_csv(
+            csv_path,
+            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+            # \x1f (unit separator) never appears in metadata, so each line is one cell
+            parse_options=pacsv.ParseOptions(
+                delimiter="\x1f",
+                quote_char=False,
+                escape_char=False,
+                invalid_row_handler=_collect_bad_row,
+            ),
+            convert_options=pacsv.ConvertOptions(column_types={"f0": pa.string()}),
+        )
+    except pa.ArrowInvalid as e:
+        if "Empty CSV file" in str(e):  # zero bytes or only blank lines
+            return [], []
+        raise
+    if bad_rows or tbl.num_columns != 1:
+        # Only possible if some line contains \x1f; refuse rather than silently drop/split rows
+        detail = f" ({len(bad_rows)} line(s) could not be read, e.g. {bad_rows[0]!r})" if bad_rows else ""
+        raise SystemExit(f"{csv_path}: lines must not contain the \\x1f control character{detail}")
+    lines = pc.utf8_trim_whitespace(tbl.column("f0"))
+    parts = pc.split_pattern(lines, "|", max_splits=1)
+    parts = parts.filter(pc.equal(pc.list_value_length(parts), 2))
+    rels = pc.utf8_trim_whitespace(pc.list_element(parts, 0))
+    texts = pc.utf8_trim_whitespace(pc.list_element(parts, 1))
+    return rels.to_pylist(), texts.to_pylist()
 
 
 def read_metadata(csv_path: str, data_root: str):
     """
     Read lines like:  wavs/0001.wav|transcript text...
-    Returns list of dicts with RELATIVE audio paths (posix style) and text.
+    Returns two parallel lists: RELATIVE audio paths (posix style) and texts.
     """
-    rows = []
+    audio_paths = []
     data_root = os.path.abspath(data_root)
 
-    with open(csv_path, "r", encoding="utf-8") as f:
-        for ln in f:
-            ln = ln.strip()
-            if not ln or "|" not in ln:
-                continue
-            rel, text = ln.split("|", 1)
-            rel = rel.strip()
-            text = text.strip()
-
-            # Normalize to a relative path rooted at data_root if an absolute was provided
-            abs_path = rel if os.path.isabs(rel) else os.path.join(data_root, rel)
-            abs_path = os.path.abspath(abs_path)
-
-            # Compute path relative to data_root to keep the dataset portable
+    rels, texts = _parse_metadata_lines(csv_path)
+    for rel, text in zip(rels, texts):
+        # Relative paths are already rooted at data_root; only absolute ones need
+        # re-rooting (string ops only, no getcwd round-trip per row)
+        if os.path.isabs(rel):
             try:
-                rel_path = os.path.relpath(abs_path, data_root)
+                rel_path = os.path.relpath(os.path.normpath(rel), data_root)
             except ValueError:
                 # On weird path mismatches, just store the basename to avoid absolute paths
-                rel_path = os.path.basename(abs_path)
+                rel_path = os.path.basename(rel)
+        else:
+            rel_path = os.path.normpath(rel)
 
-            # Use forward slashes for portability
-            rel_path = Path(rel_path).as_posix()
+        # Use forward slashes for portability
+        rel_path = rel_path.replace(os.sep, "/")
 
-            rows.append({"audio": rel_path, "text": text})
+        audio_paths.append(rel_path)
 
-    if not rows:
+    if not audio_paths:
         raise SystemExit(
             "No rows found. Check your metadata.csv formatting: 'wavs/0001.wav|transcript'"
         )
-    return rows
+    return audio_paths, texts
+
+
+def _replace_copy(src: str, dst: str) -> str:
+    """
+    copytree copy_function: shutil.copy2, but first unlink an existing dst so a
+    hardlink left by a previous run is replaced instead of written through.
+    """
+    if os.path.lexists(dst):
+        if os.path.realpath(src) == os.path.realpath(dst):
+            raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+        os.remove(dst)
+    return shutil.copy2(src, dst)
+
+
+def _hardlink_or_copy(src: str, dst: str) -> str:
+    """
+    copytree copy_function: hardlink src -> dst (no bytes copied), falling back to
+    a real copy when linking is impossible (cross-device, unsupported FS, ...).
+    """
+    if os.path.lexists(dst):
+        if os.path.samefile(src, dst):
+            return dst  # already linked by a previous run
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        _replace_copy(src, dst)
+    return dst
 
 
-def copy_wavs_tree(src_wavs_dir: str, outdir: str):
+def copy_wavs_tree(src_wavs_dir: str, outdir: str, mode: str = "copy"):
     """
     Copy the entire wavs/ tree into <outdir>/wavs so the dataset is self-contained.
+    mode:
+      - "copy":     plain byte-for-byte copy
+      - "reflink":  copy-on-write clone via `cp --reflink=auto`, else plain copy
+      - "hardlink": hardlink each file, copying only where links are impossible.
+                    The output then shares inodes with the source, so later
+                    in-place rewrites of the source show up in the dataset.
     Uses dirs_exist_ok for idempotency.
     """
     src_wavs_dir = os.path.abspath(src_wavs_dir)
     dst_wavs_dir = os.path.join(outdir, "wavs")
+    if os.path.abspath(dst_wavs_dir) == src_wavs_dir or (
+        os.path.isdir(dst_wavs_dir) and os.path.samefile(src_wavs_dir, dst_wavs_dir)
+    ):
+        raise SystemExit(
+            f"--outdir wavs/ is the source wavs/ ({src_wavs_dir}); pick a different --outdir or use --no-copy-audio."
+        )
     Path(outdir).mkdir(parents=True, exist_ok=True)
-    shutil.copytree(src_wavs_dir, dst_wavs_dir, dirs_exist_ok=True)
+
+    if mode == "reflink":
+        Path(dst_wavs_dir).mkdir(parents=True, exist_ok=True)
+        try:
+            subprocess.run(
+                ["cp", "-a", "--reflink=auto", os.path.join(src_wavs_dir, "."), dst_wavs_dir],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            return
+        except (OSError, subprocess.CalledProcessError):
+            mode = "copy"  # e.g. BSD/macOS cp without --reflink
+
+    copy_function = _hardlink_or_copy if mode == "hardlink" else _replace_copy
+    shutil.copytree(src_wavs_dir, dst_wavs_dir, copy_function=copy_function, dirs_exist_ok=True)
+
+
+def write_parquet_shards(ds: Dataset, outdir: str, split: str = "train", rows_per_file: int = 5000):
+    """
+    Write the dataset to <outdir>/data/<split>-*.parquet with pyarrow's
+    multithreaded writer (Hub-ready layout). Audio files are embedded one record
+    batch at a time (the same embedding save_to_disk does) and streamed straight
+    into the writer, so the shards are self-contained and RAM stays bounded.
+    The schema metadata carries the `datasets` features, so
+    load_dataset("parquet", ...) restores the Audio column.
+    """
+    data_dir = os.path.join(outdir, "data")
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    rows_per_group = min(rows_per_file, 500)
+    schema = ds.features.arrow_schema
+
+    def embedded_batches():
+        for batch in ds.data.table.to_batches(max_chunksize=rows_per_group):
+            yield from embed_table_storage(pa.Table.from_batches([batch])).to_batches()
+
+    pads.write_dataset(
+        embedded_batches(),
+        schema=schema,
+        base_dir=data_dir,
+        basename_template=f"{split}-{{i}}.parquet",
+        format="parquet",
+        max_rows_per_file=rows_per_file,
+        max_rows_per_group=rows_per_group,
+        use_threads=True,
+        existing_data_behavior="delete_matching",  # no stale shards from a larger previous run
+    )
+    return data_dir
+
+
+def probe_sample_rate(audio_path: str):
+    """Return the sample rate from the file header (no audio decoding), or None if unreadable."""
+    try:
+        return sf.info(audio_path).samplerate
+    except RuntimeError:  # soundfile.LibsndfileError: unknown/corrupt format
+        return None
 
 
 def main():
@@ -68,6 +205,27 @@ def main():
         action="store_true",
         help="Do NOT copy wavs/ into the saved dataset folder (you'll need to ship wavs/ separately).",
     )
+    p.add_argument(
+        "--copy-mode",
+        choices=["hardlink", "reflink", "copy"],
+        default="copy",
+        help="How to place wavs/ into the output folder (default: copy). hardlink shares the source files, so "
+             "re-running prep_dataset.py into the same wavs/ also changes this dataset's audio.",
+    )
+    p.add_argument(
+        "--no-decode",
+        action="store_true",
+        help="Save the audio column as Audio(decode=False): rows hold raw {bytes, path} and are never "
+             "decoded/resampled on access. Every file must already be at --sr.",
+    )
+    p.add_argument(
+        "--format",
+        choices=["arrow", "parquet"],
+        default="arrow",
+        help="arrow: save_to_disk (load with load_from_disk). parquet: self-contained sharded "
+             "<outdir>/data/train-*.parquet with the audio embedded, written in parallel; wavs/ is not "
+             "copied (load with load_dataset('parquet', data_dir=...)) (default: arrow)",
+    )
     args = p.parse_args()
 
     data_dir = os.path.abspath(args.data_dir)
@@ -78,47 +236,53 @@ def main():
     assert os.path.isdir(wavs_dir), f"Missing {wavs_dir} (expected your audio under data_dir/wavs/)"
 
     # Read metadata as RELATIVE paths under data_dir
-    rows = read_metadata(csv_path, data_dir)
+    audio_paths, texts = read_metadata(csv_path, data_dir)
+
+    if args.no_decode:
+        # Nothing will resample later, so every file (not just the first) must match
+        for a in audio_paths:
+            rate = probe_sample_rate(os.path.join(data_dir, a))
+            if rate != args.sr:
+                p.error(f"--no-decode needs all audio at --sr {args.sr}, but {a} is {rate or 'unreadable'}.")
 
     # === Path fix block ===
     # Ensure paths resolve correctly during save_to_disk():
     # - If copying audio, point to <outdir>/wavs/...
     # - If not copying, convert to ABSOLUTE paths rooted at data_dir.
-    if not args.no_copy_audio:
+    # Parquet shards embed the audio, so there is nothing to copy for them.
+    if not args.no_copy_audio and args.format != "parquet":
         # Copy audio into the output folder so the dataset is self-contained
-        copy_wavs_tree(wavs_dir, args.outdir)
+        copy_wavs_tree(wavs_dir, args.outdir, mode=args.copy_mode)
         # Repoint audio paths to the copied tree inside <outdir>/wavs
-        rows = [
-            {"audio": (Path(args.outdir) / r["audio"]).as_posix(), "text": r["text"]}
-            for r in rows
-        ]
+        audio_paths = [(Path(args.outdir) / a).as_posix() for a in audio_paths]
     else:
         # Keep audio in place; use absolute paths to avoid save_to_disk errors
-        rows = [
-            {"audio": (Path(data_dir) / r["audio"]).resolve().as_posix(), "text": r["text"]}
-            for r in rows
-        ]
+        audio_paths = [(Path(data_dir) / a).resolve().as_posix() for a in audio_paths]
 
     # Build dataset
-    ds = Dataset.from_dict(
-        {
-            "audio": [r["audio"] for r in rows],
-            "text": [r["text"] for r in rows],
-        }
-    )
-
-    # Cast to Audio feature; decoding will happen on the fly from the provided paths
-    ds = ds.cast_column("audio", Audio(sampling_rate=args.sr))
+    ds = Dataset.from_dict({"audio": audio_paths, "text": texts})
 
-    dd = DatasetDict({"train": ds})
+    if args.no_decode:
+        # Consumers get raw bytes; cast_column("audio", Audio()) to decode later
+        ds = ds.cast_column("audio", Audio(sampling_rate=None, decode=False))
+    else:
+        # Cast to Audio feature; decoding will happen on the fly from the provided paths
+        ds = ds.cast_column("audio", Audio(sampling_rate=args.sr))
 
     # Save locally
     Path(args.outdir).mkdir(parents=True, exist_ok=True)
-    dd.save_to_disk(args.outdir)
-
-    print("✅ Saved local DatasetDict.")
-    print(f"   Folder: {os.path.abspath(args.outdir)}")
-    if args.no_copy_audio:
+    if args.format == "parquet":
+        shards_dir = write_parquet_shards(ds, args.outdir)
+        print("✅ Saved parquet shards.")
+        print(f"   Folder: {os.path.abspath(shards_dir)}")
+    else:
+        dd = DatasetDict({"train": ds})
+        dd.save_to_disk(args.outdir)
+        print("✅ Saved local DatasetDict.")
+        print(f"   Folder: {os.path.abspath(args.outdir)}")
+    if args.format == "parquet":
+        print("🎁 Audio is embedded in the parquet shards; data/ is self-contained.")
+    elif args.no_copy_audio:
         print("⚠️  You used --no-copy-audio.")
         print("   Be sure to also upload/ship your 'wavs/' folder next to the dataset folder and keep relative paths intact.")
     else:
@@ -131,3 +295,4 @@ if __name__ == "__main__":
 # Examples:
 # python make_local_dataset.py --data_dir /path/to/data --outdir my_voice_dataset
 # python make_local_dataset.py --data_dir dataset_out --outdir my_voice_dataset
+# python make_local_dataset.py --data_dir dataset_out --outdir my_voice_dataset --format parquet
@@ -1,24 +1,75 @@
 # prep_dataset_openai.py
-import os, sys, wave, contextlib, math, pathlib
-from typing import List, Tuple, Optional
+import os, sys, wave, contextlib, pathlib, struct, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple, Optional
+
+import numpy as np
 
 # ----------------- Config (edit as needed) -----------------
 CHUNK_SEC = 10                  # seconds per chunk
 OUT_DIR   = "dataset_out"       # will contain metadata.csv + wavs/
 LANG      = "en"                # set to None for auto
+MAX_WORKERS = 16                # parallel API requests (upper bound)
+MAX_RETRIES = 5                 # retries on rate limit / connection errors
+SPLIT_WORKERS = 8               # parallel chunk writers in split_wav (upper bound)
+BATCH_BYTES = 20 * 1024 * 1024  # --batch: audio per upload (API limit is 25 MB)
 # -----------------------------------------------------------
 from dotenv import load_dotenv
 load_dotenv()
 # OpenAI SDK (v1+)
-from openai import OpenAI
+from openai import OpenAI, RateLimitError, APIConnectionError
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))  # uses OPENAI_API_KEY from env
 
 def ensure_dir(p: str) -> None:
     pathlib.Path(p).mkdir(parents=True, exist_ok=True)
 
+def _find_data_offset(in_wav: str) -> int:
+    """
+    Walk the RIFF chunk list and return the byte offset of the PCM payload
+    (start of the 'data' chunk body).
+    """
+    with open(in_wav, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(f"Not a RIFF/WAVE file: {in_wav}")
+        while True:
+            hdr = f.read(8)
+            if len(hdr) < 8:
+                raise ValueError(f"No data chunk found in {in_wav}")
+            cid, size = struct.unpack("<4sI", hdr)
+            if cid == b"data":
+                return f.tell()
+            f.seek(size + (size & 1), os.SEEK_CUR)  # chunks are word-aligned
+
+def _make_wav_header(nchan: int, sw: int, rate: int, data_len: int) -> bytes:
+    """Canonical 44-byte PCM WAV header (same layout the `wave` module writes)."""
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_len, b"WAVE",
+        b"fmt ", 16, 1, nchan, rate, rate * nchan * sw, nchan * sw, sw * 8,
+        b"data", data_len,
+    )
+
+def _write_chunk(out_path: str, hdr: bytes, pcm) -> None:
+    """Write header + PCM in one syscall (writev) where available."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(out_path, flags, 0o644)
+    try:
+        if hasattr(os, "writev"):
+            done = os.writev(fd, [hdr, pcm])
+            rest = memoryview(hdr + bytes(pcm))[done:] if done < len(hdr) + pcm.nbytes else b""
+        else:
+            rest = memoryview(hdr + bytes(pcm))
+        while rest:  # finish short writes
+            rest = rest[os.write(fd, rest):]
+    finally:
+        os.close(fd)
+
 def split_wav(in_wav: str, out_dir: str, chunk_sec: int = 10) -> List[Tuple[str, str]]:
     """
     Split a PCM WAV file into fixed-length chunks WITHOUT re-encoding.
+    The PCM payload is memory-mapped once and each chunk is written (in parallel)
+    as a header + slice of the map, so samples never pass through the `wave` module.
     Returns list of (filename, fullpath).
     """
     ensure_dir(out_dir)
@@ -32,32 +83,52 @@ def split_wav(in_wav: str, out_dir: str, chunk_sec: int = 10) -> List[Tuple[str,
         rate  = wf.getframerate()
         nfrm  = wf.getnframes()
 
-        frames_per_chunk = int(rate * chunk_sec)
-        if frames_per_chunk <= 0:
-            raise ValueError("chunk_sec must be > 0")
-        n_chunks = math.ceil(nfrm / frames_per_chunk)
-        if n_chunks == 0:
-            raise ValueError("Input WAV appears empty.")
-
-        for i in range(n_chunks):
-            wf.setpos(i * frames_per_chunk)
-            frames = wf.readframes(min(frames_per_chunk, nfrm - i * frames_per_chunk))
-            name = f"{i+1:04d}.wav"
-            out_path = os.path.join(out_dir, name)
-            with contextlib.closing(wave.open(out_path, "wb")) as out_wav:
-                out_wav.setnchannels(nchan)
-                out_wav.setsampwidth(sw)
-                out_wav.setframerate(rate)
-                out_wav.writeframes(frames)
-            out.append((name, out_path))
+    # A truncated file can declare more frames than it holds; only map what's there.
+    frame_bytes = nchan * sw
+    data_offset = _find_data_offset(in_wav)
+    nfrm = min(nfrm, (os.path.getsize(in_wav) - data_offset) // frame_bytes)
+
+    frames_per_chunk = int(rate * chunk_sec)
+    if frames_per_chunk <= 0:
+        raise ValueError("chunk_sec must be > 0")
+    n_chunks = (nfrm + frames_per_chunk - 1) // frames_per_chunk
+    if n_chunks == 0:
+        raise ValueError("Input WAV appears empty.")
+
+    # One row per frame, raw bytes per row: works for any sample width.
+    buf = np.memmap(in_wav, dtype=np.uint8, mode="r",
+                    offset=data_offset, shape=(nfrm, frame_bytes))
+    full_hdr = _make_wav_header(nchan, sw, rate, frames_per_chunk * frame_bytes)
+
+    # Chunk byte ranges are known up front and independent, so write them concurrently
+    # (writev releases the GIL; helps on NVMe, harmless elsewhere).
+    # Frame offsets are precomputed so the workers do no index arithmetic.
+    jobs = []
+    pos = 0
+    for i in range(n_chunks):
+        name = f"{i+1:04d}.wav"
+        out_path = os.path.join(out_dir, name)
+        out.append((name, out_path))
+        jobs.append((out_path, pos, min(pos + frames_per_chunk, nfrm)))
+        pos += frames_per_chunk
+
+    def write_chunk(job: Tuple[str, int, int]) -> None:
+        out_path, start, end = job
+        n = end - start
+        hdr = full_hdr if n == frames_per_chunk else _make_wav_header(nchan, sw, rate, n * frame_bytes)
+        _write_chunk(out_path, hdr, buf[start:end])
+
+    with ThreadPoolExecutor(max_workers=min(SPLIT_WORKERS, os.cpu_count() or 1)) as ex:
+        list(ex.map(write_chunk, jobs))  # list() re-raises any write error
     return out
 
+# no newlines in the CSV row; guard our delimiter
+_SANITIZE_TABLE = str.maketrans({"\r": " ", "\n": " ", "|": "/"})
+
 def sanitize_for_metadata(s: str) -> str:
-    # Keep metadata.csv one row per chunk; avoid breaking the delimiter
-    s = s.replace("\r\n", "\n").replace("\r", "\n")
-    s = s.replace("\n", " ")     # no newlines in the CSV row
-    s = s.replace("|", "/")      # guard our delimiter
-    return s.strip()
+    # Keep metadata.csv one row per chunk; avoid breaking the delimiter.
+    # CRLF is folded first so it still becomes a single space.
+    return s.replace("\r\n", "\n").translate(_SANITIZE_TABLE).strip()
 
 def transcribe_chunk_openai(chunk_path: str, lang: Optional[str] = "en") -> str:
     """
@@ -76,14 +147,80 @@ def transcribe_chunk_openai(chunk_path: str, lang: Optional[str] = "en") -> str:
     # SDK returns a str when response_format="text"
     return str(transcript).strip()
 
+def group_chunks(chunks: List[Tuple[str, str]], max_bytes: int = BATCH_BYTES) -> List[List[int]]:
+    """
+    Group consecutive chunk indices so each group's WAVs total at most max_bytes
+    (one upload per group). A chunk larger than max_bytes gets its own group.
+    """
+    groups: List[List[int]] = []
+    cur: List[int] = []
+    cur_bytes = 0
+    for idx, (_, fpath) in enumerate(chunks):
+        size = os.path.getsize(fpath)
+        if cur and cur_bytes + size > max_bytes:
+            groups.append(cur)
+            cur, cur_bytes = [], 0
+        cur.append(idx)
+        cur_bytes += size
+    if cur:
+        groups.append(cur)
+    return groups
+
+def transcribe_batch_openai(chunk_paths: List[str], chunk_sec: int, lang: Optional[str] = "en") -> List[str]:
+    """
+    Concatenate consecutive chunk WAVs into one upload, transcribe it with segment
+    timestamps, and assign each segment to the chunk its start time falls in.
+    Returns one text per input chunk (segments crossing a boundary stay with the
+    chunk they start in).
+    """
+    with contextlib.closing(wave.open(chunk_paths[0], "rb")) as wf:
+        nchan, sw, rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+    pcm = bytearray()
+    for path in chunk_paths:
+        offset = _find_data_offset(path)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            pcm += f.read()
+    payload = _make_wav_header(nchan, sw, rate, len(pcm)) + pcm
+
+    transcript = client.audio.transcriptions.create(
+        model="whisper-1",
+        file=("batch.wav", payload, "audio/wav"),
+        language=lang if lang else None,
+        response_format="verbose_json",
+        timestamp_granularities=["segment"],
+    )
+    parts: List[List[str]] = [[] for _ in chunk_paths]
+    for seg in transcript.segments or []:
+        i = min(int(seg.start // chunk_sec), len(chunk_paths) - 1)
+        parts[i].append(seg.text.strip())
+    return [" ".join(p) for p in parts]
+
+def with_retry(fn, *args, retries: int = MAX_RETRIES):
+    """
+    Call fn(*args) with exponential backoff on rate limits / dropped connections.
+    Other errors are raised immediately.
+    """
+    delay = 1.0
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args)
+        except (RateLimitError, APIConnectionError):
+            if attempt == retries:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python prep_dataset_openai.py <input.wav> [--chunk-sec N] [--lang en|None]")
+        print("Usage: python prep_dataset_openai.py <input.wav> [--chunk-sec N] [--lang en|None] [--workers N] [--batch]")
         sys.exit(1)
 
     in_wav = sys.argv[1]
     chunk_sec = CHUNK_SEC
     lang = LANG
+    workers: Optional[int] = None
+    batch = False
 
     # simple optional flags
     i = 2
@@ -93,6 +230,10 @@ def main():
             chunk_sec = int(sys.argv[i+1]); i += 2
         elif tok == "--lang" and i+1 < len(sys.argv):
             lang = None if sys.argv[i+1].lower() == "none" else sys.argv[i+1]; i += 2
+        elif tok == "--workers" and i+1 < len(sys.argv):
+            workers = int(sys.argv[i+1]); i += 2
+        elif tok == "--batch":
+            batch = True; i += 1
         else:
             print(f"Unknown arg: {tok}"); sys.exit(1)
 
@@ -109,26 +250,66 @@ def main():
     print("Splitting...")
     chunks = split_wav(in_wav, wavs_dir, chunk_sec)
 
-    print("Transcribing (OpenAI Whisper)…")
-    meta_lines: List[str] = []
-    for fname, fpath in chunks:
-        try:
-            txt = transcribe_chunk_openai(fpath, lang=lang)
-        except Exception as e:
-            print(f"  ERROR on {fname}: {e}")
-            txt = ""  # keep going; fix later if needed
-
-        txt = sanitize_for_metadata(txt)
-        meta_lines.append(f"wavs/{fname}|{txt}")
-        if txt:
-            preview = (txt[:60] + "...") if len(txt) > 60 else txt
-            print(f"  {fname}: {preview}")
-        else:
-            print(f"  {fname}: (no text)")
+    # One upload per chunk, or (--batch) one per group of consecutive chunks
+    if batch:
+        jobs = group_chunks(chunks)
+    else:
+        jobs = [[idx] for idx in range(len(chunks))]
+
+    if workers is None:
+        workers = min(MAX_WORKERS, len(jobs))
+    workers = max(1, workers)
 
+    print(f"Transcribing (OpenAI Whisper, {len(jobs)} requests, {workers} workers)…")
+    # Requests are network-bound, so run them concurrently. Rows are streamed to
+    # metadata.csv in chunk order as soon as every earlier chunk has finished, so
+    # a crash still leaves a valid (partial) metadata file behind.
     meta_path = os.path.join(OUT_DIR, "metadata.csv")
-    with open(meta_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(meta_lines))
+    texts: Dict[int, str] = {}
+    next_idx = 0
+    with open(meta_path, "w", encoding="utf-8", buffering=1 << 20) as meta_f, \
+            ThreadPoolExecutor(max_workers=workers) as ex:
+        try:
+            futs = {}
+            for job in jobs:
+                if batch:
+                    fut = ex.submit(with_retry, transcribe_batch_openai,
+                                    [chunks[idx][1] for idx in job], chunk_sec, lang)
+                else:
+                    fut = ex.submit(with_retry, transcribe_chunk_openai, chunks[job[0]][1], lang)
+                futs[fut] = job
+            for fut in as_completed(futs):
+                job = futs[fut]
+                try:
+                    job_texts = fut.result()
+                    if not batch:
+                        job_texts = [job_texts]
+                except Exception as e:
+                    names = ", ".join(chunks[idx][0] for idx in job)
+                    print(f"  ERROR on {names}: {e}")
+                    job_texts = [""] * len(job)  # keep going; fix later if needed
+
+                for idx, txt in zip(job, job_texts):
+                    fname = chunks[idx][0]
+                    txt = sanitize_for_metadata(txt)
+                    texts[idx] = txt
+                    if txt:
+                        preview = (txt[:60] + "...") if len(txt) > 60 else txt
+                        print(f"  {fname}: {preview}")
+                    else:
+                        print(f"  {fname}: (no text)")
+
+                # Only this (main) thread touches meta_f, so no lock is needed
+                if next_idx in texts:
+                    while next_idx in texts:
+                        meta_f.write(f"wavs/{chunks[next_idx][0]}|{texts.pop(next_idx)}\n")
+                        next_idx += 1
+                    meta_f.flush()
+        except BaseException:
+            # Ctrl-C / unexpected error: drop queued (billed) requests instead of
+            # letting the executor drain them on exit
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
 
     print(f"\nDone.\nWrote {meta_path}\nChunks in {wavs_dir}")
 